@@ -3,74 +3,177 @@ Convert trained models to TensorFlow Lite format
 """
 
 import os
+import re
+import tempfile
 import tensorflow as tf
 from pathlib import Path
 import numpy as np
 from PIL import Image
 
+# Supported conversion targets, see TFLiteConverter.convert_model
+PRECISIONS = ('int8', 'fp16', 'dynamic', 'float32')
+
+# Also written as the un-suffixed {model_name}.tflite the app require()s; the app
+# feeds Float32Array inputs, so the default must keep float I/O (int8 does not)
+DEFAULT_PRECISION = 'dynamic'
+
+# INT8 calibration inputs per model, matching what each model sees at inference:
+# full pages for the staff detector, <class_id>_<n>.png crops for the symbol recognizer
+# (same naming as SYMBOL_FILE_PATTERN in train_omr_models_fast.py)
+CALIBRATION_PATTERNS = {
+    'staff_detector': re.compile(r'^background_.*\.jpe?g$'),
+    'symbol_recognizer': re.compile(r'^\d+_.*\.png$'),
+}
+
 class TFLiteConverter:
     """Convert Keras models to quantized TFLite format"""
     
-    def __init__(self, model_dir, output_dir):
+    def __init__(self, model_dir, output_dir, representative_data_dir=None,
+                 num_calibration_samples=1000):
         self.model_dir = Path(model_dir)
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.representative_data_dir = Path(representative_data_dir) if representative_data_dir else None
+        self.num_calibration_samples = num_calibration_samples
+    
+    def _representative_files(self, model_name):
+        """List the input images used to calibrate INT8 activations for a model"""
+        pattern = CALIBRATION_PATTERNS.get(model_name)
+        if pattern is None or self.representative_data_dir is None or not self.representative_data_dir.exists():
+            return []
+        return sorted(p for p in self.representative_data_dir.iterdir() if pattern.match(p.name))
     
-    def convert_model(self, model_name, quantize=True):
-        """Convert a single model to TFLite"""
-        print(f"\nConverting {model_name}...")
+    def _representative_dataset(self, model, files):
+        """Build a generator yielding preprocessed calibration samples for the model input"""
+        height, width = model.input_shape[1:3]
+        
+        def gen():
+            for path in files:
+                img = Image.open(path).convert('RGB')
+                img = img.resize((width, height), Image.Resampling.BILINEAR)
+                sample = np.asarray(img, dtype=np.float32) / 255.0
+                yield [np.expand_dims(sample, 0)]
+        
+        return gen
+    
+    def convert_model(self, model_name, precision=DEFAULT_PRECISION):
+        """
+        Convert a single model to TFLite
+        
+        precision: 'int8' (full-integer, needs representative data), 'fp16'
+        (float16 weights, for GPU delegates), 'dynamic' (dynamic-range) or
+        'float32' (no optimization). Saved as {model_name}_{precision}.tflite;
+        DEFAULT_PRECISION is also saved as {model_name}.tflite.
+        """
+        print(f"\nConverting {model_name} ({precision})...")
+        
+        if precision not in PRECISIONS:
+            print(f"❌ Unknown precision: {precision} (expected one of {', '.join(PRECISIONS)})")
+            return False
         
         model_path = self.model_dir / f'{model_name}.h5'
         if not model_path.exists():
             print(f"❌ Model not found: {model_path}")
             return False
         
+        files = self._representative_files(model_name) if precision == 'int8' else []
+        if precision == 'int8' and not files:
+            print(f"❌ No representative data for {model_name} INT8 calibration in: {self.representative_data_dir}")
+            return False
+        # Repeating an image cannot widen the observed activation ranges, so cap at distinct files
+        files = files[:self.num_calibration_samples]
+        
         # Load model
         model = tf.keras.models.load_model(model_path)
         
-        # Simple conversion using from_keras_model
-        converter = tf.lite.TFLiteConverter.from_keras_model(model)
-        
-        if quantize:
-            print("  Applying optimization...")
-            # Use DEFAULT optimization (doesn't require representative dataset)
-            converter.optimizations = [tf.lite.Optimize.DEFAULT]
-        
-        tflite_model = converter.convert()
+        # Convert via SavedModel so the graph is optimized (constant folding,
+        # conv+BN+activation fusion, dead-node pruning) before quantization
+        with tempfile.TemporaryDirectory() as saved_model_dir:
+            # Keras 3 needs model.export(): tf.saved_model.save leaves the serving function
+            # reading uninitialized resource variables, which breaks conversion. Legacy
+            # Keras 2 models have no export() and save correctly via tf.saved_model.save
+            if hasattr(model, 'export'):
+                model.export(saved_model_dir)
+            else:
+                tf.saved_model.save(model, saved_model_dir)
+            converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+            converter.experimental_new_converter = True  # MLIR pipeline
+            
+            if precision != 'float32':
+                converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            
+            if precision == 'int8':
+                # Full-integer quantization: calibrate activations so every op runs INT8 kernels
+                print(f"  Applying full INT8 quantization ({len(files)} calibration samples)...")
+                converter.representative_dataset = self._representative_dataset(model, files)
+                converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+                converter.inference_input_type = tf.int8
+                converter.inference_output_type = tf.int8
+                # Per-channel weight scales (default in recent TF, explicit here) keep
+                # separable/depthwise layers accurate at INT8
+                converter._experimental_disable_per_channel = False
+            elif precision == 'fp16':
+                # Float16 weights: half the size, runs natively on GPU delegates
+                print("  Applying float16 quantization...")
+                converter.target_spec.supported_types = [tf.float16]
+            elif precision == 'dynamic':
+                print("  Applying dynamic-range optimization...")
+            
+            try:
+                tflite_model = converter.convert()
+            except Exception as e:
+                print(f"❌ {precision} conversion failed for {model_name}: {e}")
+                return False
         
         # Save TFLite model
-        output_path = self.output_dir / f'{model_name}.tflite'
-        with open(output_path, 'wb') as f:
-            f.write(tflite_model)
+        output_names = [f'{model_name}_{precision}.tflite']
+        if precision == DEFAULT_PRECISION:
+            output_names.append(f'{model_name}.tflite')
+        for output_name in output_names:
+            output_path = self.output_dir / output_name
+            with open(output_path, 'wb') as f:
+                f.write(tflite_model)
+            print(f"✓ Saved {output_path}")
         
         model_size_mb = len(tflite_model) / (1024 * 1024)
-        print(f"✓ Saved {output_path}")
         print(f"  Size: {model_size_mb:.2f} MB")
         
         return True
     
-    def convert_all(self, model_names=['staff_detector', 'symbol_recognizer'], quantize=True):
-        """Convert all models"""
+    def convert_all(self, model_names=['staff_detector', 'symbol_recognizer'],
+                    precisions=(DEFAULT_PRECISION, 'int8', 'fp16')):
+        """Convert all models, one .tflite per precision plus the default un-suffixed build"""
+        # The app's build (DEFAULT_PRECISION) goes first; a failing variant is reported
+        # and skipped so it cannot stop the remaining conversions
+        failed = []
         print("="*60)
         print("CONVERTING MODELS TO TFLITE")
         print("="*60)
         
         for model_name in model_names:
-            self.convert_model(model_name, quantize=quantize)
+            for precision in precisions:
+                if not self.convert_model(model_name, precision=precision):
+                    failed.append(f'{model_name}_{precision}')
         
         print("\n" + "="*60)
         print("CONVERSION COMPLETE")
         print("="*60)
         print(f"TFLite models saved to: {self.output_dir}/")
-        print("Copy .tflite files to: sheet-music-scanner/src/assets/models/")
+        if failed:
+            print(f"❌ Failed variants: {', '.join(failed)}")
+        print("Copy staff_detector.tflite and symbol_recognizer.tflite to: sheet-music-scanner/src/assets/models/")
+        print(f"  (those are the {DEFAULT_PRECISION} builds with float32 I/O; _int8 variants take int8 I/O")
+        print("   and suit omr_service_real.py, _fp16 variants target GPU delegates)")
 
 def main():
     # Configuration
     model_dir = './trained_models'
     output_dir = './tflite_models'
     
-    converter = TFLiteConverter(model_dir, output_dir)
-    converter.convert_all(quantize=True)
+    representative_data_dir = './potentialmodels'
+    
+    converter = TFLiteConverter(model_dir, output_dir, representative_data_dir)
+    converter.convert_all()
 
 if __name__ == '__main__':
     main()
@@ -3,23 +3,85 @@ OMR Service - Real Model Integration
 Uses trained staff detector and symbol recognizer models
 """
 
+import os
 import numpy as np
 import cv2
 from pathlib import Path
 from typing import List, Dict, Any
 
-class StaffDetector:
-    """Detect staff lines in sheet music"""
+
+def _quantize_input(data: np.ndarray, details: Dict[str, Any]) -> np.ndarray:
+    """Quantize normalized float input to the tensor's integer type if required"""
+    dtype = details['dtype']
+    if dtype in (np.int8, np.uint8):
+        params = details['quantization_parameters']
+        scale, zero_point = params['scales'][0], params['zero_points'][0]
+        info = np.iinfo(dtype)
+        data = np.clip(np.round(data / scale + zero_point), info.min, info.max)
+    return data.astype(dtype)
+
+
+def _dequantize_output(data: np.ndarray, details: Dict[str, Any]) -> np.ndarray:
+    """Map integer model output back to float using the tensor's scale/zero point"""
+    if details['dtype'] in (np.int8, np.uint8):
+        params = details['quantization_parameters']
+        scale, zero_point = params['scales'][0], params['zero_points'][0]
+        return (data.astype(np.float32) - zero_point) * scale
+    return data
+
+
+def _load_interpreter(model_path: str):
+    """
+    Create a multithreaded TFLite interpreter backed by XNNPACK
+    
+    The BUILTIN op resolver applies XNNPACK as the default CPU delegate, so
+    all conv/dense ops run on its SIMD microkernels across every core.
+    """
+    import tensorflow as tf
+    interpreter = tf.lite.Interpreter(
+        model_path=model_path,
+        num_threads=os.cpu_count(),
+        experimental_op_resolver_type=tf.lite.experimental.OpResolverType.BUILTIN
+    )
+    interpreter.allocate_tensors()
+    return interpreter
+
+
+class _TFLiteModel:
+    """Shared TFLite interpreter setup and in-place input writing"""
     
     def __init__(self, model_path: str):
         """Initialize with TFLite model"""
-        import tensorflow as tf
-        self.interpreter = tf.lite.Interpreter(model_path=model_path)
-        self.interpreter.allocate_tensors()
+        self.interpreter = _load_interpreter(model_path)
         
         self.input_details = self.interpreter.get_input_details()
         self.output_details = self.interpreter.get_output_details()
         self.input_size = tuple(self.input_details[0]['shape'][1:3])
+        
+        # Cache tensor indices and the normalization table; inputs are written in place.
+        # Keep the tensor() accessor, not its array: holding the view blocks invoke().
+        self._in_idx = self.input_details[0]['index']
+        self._out_idx = self.output_details[0]['index']
+        self._in_tensor = self.interpreter.tensor(self._in_idx)
+        self._input_lut = _quantize_input(np.arange(256, dtype=np.float32) / 255.0, self.input_details[0])
+        self._alloc_shape = 1  # batch size the tensors are currently allocated for
+    
+    def _ensure_shape(self, n: int):
+        """Resize the input tensor to batch n, re-allocating only when n changes"""
+        if self._alloc_shape != n:
+            self.interpreter.resize_tensor_input(self._in_idx, [n, *self.input_size, 3])
+            self.interpreter.allocate_tensors()
+            self._alloc_shape = n
+    
+    def _set_input(self, blob: np.ndarray):
+        """Normalize (and quantize) an NCHW uint8 blob straight into the input buffer"""
+        # mode='clip' lets take() write into the tensor directly (mode='raise' buffers a copy);
+        # uint8 indices always fall inside the 256-entry table, so nothing is ever clipped
+        np.take(self._input_lut, blob.transpose(0, 2, 3, 1), out=self._in_tensor(), mode='clip')
+
+
+class StaffDetector(_TFLiteModel):
+    """Detect staff lines in sheet music"""
     
     def detect(self, image: np.ndarray) -> Dict[str, Any]:
         """
@@ -33,22 +95,26 @@ class StaffDetector:
         """
         # Preprocess
         h, w = image.shape[:2]
-        input_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        input_image = cv2.resize(input_image, self.input_size)
-        input_image = input_image.astype(np.float32) / 255.0
+        self._set_input(cv2.dnn.blobFromImage(
+            image, size=self.input_size, swapRB=True, crop=False, ddepth=cv2.CV_8U
+        ))
         
         # Run inference
-        self.interpreter.set_tensor(
-            self.input_details[0]['index'],
-            np.expand_dims(input_image, 0)
-        )
         self.interpreter.invoke()
         
         # Get output
-        segmentation = self.interpreter.get_tensor(
-            self.output_details[0]['index']
+        segmentation = _dequantize_output(
+            self.interpreter.get_tensor(self._out_idx), self.output_details[0]
         )[0]  # Shape: (height, width, 1)
         
+        # Blank frame: nothing above threshold, skip the upsample and contour search
+        if segmentation.max() < 0.5:
+            return {
+                'staffs': [],
+                'segmentation_mask': np.zeros((h, w), dtype=np.uint8),
+                'confidence': float(segmentation.mean())
+            }
+        
         # Post-process
         mask = (segmentation[:, :, 0] > 0.5).astype(np.uint8)
         mask = cv2.resize(mask, (w, h), interpolation=cv2.INTER_NEAREST)
@@ -56,35 +122,34 @@ class StaffDetector:
         # Find contours (staff regions)
         contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         
+        bboxes = np.array([cv2.boundingRect(cnt) for cnt in contours], dtype=np.int32).reshape(-1, 4)
+        
+        # Filter small contours, then sort by y
+        keep = np.flatnonzero(bboxes[:, 3] > 20)
+        order = keep[np.argsort(bboxes[keep, 1], kind='stable')]
+        
         staffs = []
-        for cnt in contours:
-            x, y, w_box, h_box = cv2.boundingRect(cnt)
-            if h_box > 20:  # Filter small contours
-                staffs.append({
-                    'bbox': (x, y, w_box, h_box),
-                    'confidence': float(np.mean(segmentation[y:y+h_box, x:x+w_box])),
-                    'contour': cnt
-                })
+        for i in order:
+            x, y, w_box, h_box = (int(v) for v in bboxes[i])
+            staffs.append({
+                'bbox': (x, y, w_box, h_box),
+                'confidence': float(segmentation[y:y+h_box, x:x+w_box, 0].mean()),
+                'contour': contours[i]
+            })
         
         return {
-            'staffs': sorted(staffs, key=lambda s: s['bbox'][1]),  # Sort by y
+            'staffs': staffs,
             'segmentation_mask': mask,
             'confidence': float(np.mean(segmentation))
         }
 
 
-class SymbolRecognizer:
+class SymbolRecognizer(_TFLiteModel):
     """Recognize musical symbols"""
     
     def __init__(self, model_path: str, class_mapping: Dict[int, str]):
         """Initialize with TFLite model"""
-        import tensorflow as tf
-        self.interpreter = tf.lite.Interpreter(model_path=model_path)
-        self.interpreter.allocate_tensors()
-        
-        self.input_details = self.interpreter.get_input_details()
-        self.output_details = self.interpreter.get_output_details()
-        self.input_size = tuple(self.input_details[0]['shape'][1:3])
+        super().__init__(model_path)
         self.class_mapping = class_mapping
     
     def recognize(self, symbol_image: np.ndarray) -> Dict[str, Any]:
@@ -97,30 +162,48 @@ class SymbolRecognizer:
         Returns:
             Dict with class, confidence
         """
+        return self.recognize_batch([symbol_image])[0]
+    
+    def recognize_batch(self, symbol_images: List[np.ndarray]) -> List[Dict[str, Any]]:
+        """
+        Recognize several symbols with a single interpreter invocation
+        
+        Args:
+            symbol_images: Cropped symbol images
+            
+        Returns:
+            List of dicts with class, confidence (one per input image)
+        """
+        if not symbol_images:
+            return []
+        
+        self._ensure_shape(len(symbol_images))
+        
         # Preprocess
-        img = cv2.cvtColor(symbol_image, cv2.COLOR_BGR2RGB)
-        img = cv2.resize(img, self.input_size)
-        img = img.astype(np.float32) / 255.0
+        self._set_input(cv2.dnn.blobFromImages(
+            symbol_images, size=self.input_size, swapRB=True, crop=False, ddepth=cv2.CV_8U
+        ))
         
         # Run inference
-        self.interpreter.set_tensor(
-            self.input_details[0]['index'],
-            np.expand_dims(img, 0)
-        )
         self.interpreter.invoke()
         
         # Get output
-        predictions = self.interpreter.get_tensor(
-            self.output_details[0]['index']
-        )[0]
-        
-        class_idx = np.argmax(predictions)
-        confidence = float(predictions[class_idx])
+        predictions = _dequantize_output(
+            self.interpreter.get_tensor(self._out_idx), self.output_details[0]
+        )  # Shape: (n, num_classes)
+        class_ids = np.argmax(predictions, axis=1)
         
+        return [
+            self._format_prediction(int(class_idx), preds)
+            for class_idx, preds in zip(class_ids, predictions)
+        ]
+    
+    def _format_prediction(self, class_idx: int, predictions: np.ndarray) -> Dict[str, Any]:
+        """Build the result dict for one symbol's class probabilities"""
         return {
             'class': self.class_mapping.get(class_idx, f'class_{class_idx}'),
-            'class_id': int(class_idx),
-            'confidence': confidence,
+            'class_id': class_idx,
+            'confidence': float(predictions[class_idx]),
             'all_predictions': {
                 self.class_mapping.get(i, f'class_{i}'): float(p)
                 for i, p in enumerate(predictions)
@@ -139,6 +222,10 @@ class OMRService:
         return cls._instance
     
     def __init__(self):
+        # __init__ runs on every OMRService() call; only set up the shared instance once
+        if getattr(self, '_inited', False):
+            return
+        self._inited = True
         self.staff_detector = None
         self.symbol_recognizer = None
         self.is_initialized = False
@@ -207,21 +294,22 @@ class OMRService:
                 # Simple symbol detection: find connected components
                 symbols = self._extract_symbols(staff_region)
                 
-                # Recognize each symbol
+                # Recognize all symbols on the staff in one batch
                 measure = {
                     'staff_id': staff_idx,
                     'symbols': []
                 }
                 
-                for sym_idx, symbol_img in enumerate(symbols):
-                    if symbol_img.size > 0:
-                        result = self.symbol_recognizer.recognize(symbol_img)
-                        measure['symbols'].append({
-                            'index': sym_idx,
-                            'type': result['class'],
-                            'confidence': result['confidence'],
-                            'position_x': sym_idx  # Relative position in staff
-                        })
+                indices = [i for i, symbol_img in enumerate(symbols) if symbol_img.size > 0]
+                results = self.symbol_recognizer.recognize_batch([symbols[i] for i in indices])
+                
+                for sym_idx, result in zip(indices, results):
+                    measure['symbols'].append({
+                        'index': sym_idx,
+                        'type': result['class'],
+                        'confidence': result['confidence'],
+                        'position_x': sym_idx  # Relative position in staff
+                    })
                 
                 measures.append(measure)
             
@@ -243,17 +331,17 @@ class OMRService:
         # Threshold
         _, binary = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY_INV)
         
-        # Find contours
-        contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # Connected components: bboxes for every blob in one pass (label 0 is background)
+        _, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+        stats = stats[1:]
         
-        symbols = []
-        for cnt in contours:
-            x, y, w, h = cv2.boundingRect(cnt)
-            if w > 5 and h > 5:  # Filter noise
-                symbol = staff_image[y:y+h, x:x+w]
-                symbols.append(symbol)
+        # Filter noise, then order left to right
+        keep = (stats[:, cv2.CC_STAT_WIDTH] > 5) & (stats[:, cv2.CC_STAT_HEIGHT] > 5)
+        stats = stats[keep]
+        stats = stats[np.argsort(stats[:, cv2.CC_STAT_LEFT], kind='stable')]
         
-        return sorted(symbols, key=lambda s: cv2.boundingRect(cv2.findNonZero(cv2.cvtColor(s, cv2.COLOR_BGR2GRAY)))[0] if cv2.findNonZero(cv2.cvtColor(s, cv2.COLOR_BGR2GRAY)) is not None else 0)
+        # Columns are LEFT, TOP, WIDTH, HEIGHT, AREA
+        return [staff_image[y:y+h, x:x+w] for x, y, w, h, _ in stats]
 
 # Singleton instance
 _omr_service = OMRService()
@@ -4,6 +4,9 @@ Trains smaller, faster models suitable for mobile
 """
 
 import os
+import re
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import tensorflow as tf
 from tensorflow import keras
@@ -20,7 +23,10 @@ def cv2_resize(image, size):
         img = Image.fromarray(image)
     else:
         img = image
-    return np.array(img.resize(size, Image.Resampling.LANCZOS))
+    return np.array(img.resize(size, Image.Resampling.BILINEAR))
+
+# Symbol images are named <class_id>_<n>.png
+SYMBOL_FILE_PATTERN = re.compile(r'^(\d+)_')
 
 # Configuration - OPTIMIZED FOR SPEED
 CONFIG = {
@@ -31,6 +37,8 @@ CONFIG = {
     'batch_size': 4,
     'epochs': 20,  # Fewer epochs
     'augmentation': True,
+    'mixed_precision': True,  # mixed_float16 on GPU; CPU stays float32 unless opted in below
+    'bfloat16_on_cpu': False,  # only enable on CPUs with native bf16 (AVX512-BF16/AMX)
     'quantize': True,
 }
 
@@ -42,50 +50,66 @@ class FastDataLoader:
         self.staff_size = staff_size
         self.symbol_size = symbol_size
         self.symbol_classes = {}
+        self._index = None
+    
+    def _index_data_dir(self):
+        """List the data directory once, categorizing files in a single pass"""
+        if self._index is None:
+            backgrounds, overlays, symbol_files = [], [], {}
+            for f in sorted(os.listdir(self.data_dir)):
+                if f.startswith('background_') and f.endswith('.jpeg'):
+                    backgrounds.append(f)
+                elif f.startswith('overlay_') and f.endswith('.png'):
+                    overlays.append(f)
+                elif f.endswith('.png'):
+                    match = SYMBOL_FILE_PATTERN.match(f)
+                    if match:
+                        symbol_files.setdefault(match.group(1), []).append(f)
+            self._index = (backgrounds, overlays, symbol_files)
+        return self._index
         
     def load_staff_detection_data(self):
         """Load background/overlay pairs for staff detection"""
-        backgrounds = sorted([f for f in os.listdir(self.data_dir) if f.startswith('background_') and f.endswith('.jpeg')])
-        overlays = sorted([f for f in os.listdir(self.data_dir) if f.startswith('overlay_') and f.endswith('.png')])
+        backgrounds, overlays, _ = self._index_data_dir()
         
         images = []
         masks = []
         
         print(f"Loading {len(backgrounds)} staff detection training images...")
         
-        for i, (bg_file, overlay_file) in enumerate(zip(backgrounds, overlays)):
-            print(f"  [{i+1}/{len(backgrounds)}] {bg_file}", end='\r')
-            
-            # Load background
-            bg_path = self.data_dir / bg_file
-            img = np.array(Image.open(bg_path).convert('RGB'))
-            img = cv2_resize(img, self.staff_size)
-            img = img.astype(np.float32) / 255.0
-            images.append(img)
-            
-            # Load mask
-            mask_path = self.data_dir / overlay_file
-            mask = np.array(Image.open(mask_path).convert('L'))
-            mask = cv2_resize(mask, self.staff_size)
-            mask = (mask > 127).astype(np.float32)
-            masks.append(np.expand_dims(mask, axis=-1))
+        # PIL releases the GIL while decoding, so threads load pairs in parallel
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            pairs = executor.map(self._load_staff_pair, backgrounds, overlays)
+            for i, (bg_file, (img, mask)) in enumerate(zip(backgrounds, pairs)):
+                print(f"  [{i+1}/{len(backgrounds)}] {bg_file}", end='\r')
+                images.append(img)
+                masks.append(mask)
         
         print(f"\n✓ Loaded {len(images)} images")
-        return np.array(images), np.array(masks)
+        return np.asarray(images), np.asarray(masks)
+    
+    def _load_staff_pair(self, bg_file, overlay_file):
+        """Load one background image and its staff mask"""
+        # Load background
+        img = np.array(Image.open(self.data_dir / bg_file).convert('RGB'))
+        img = cv2_resize(img, self.staff_size)
+        img = img.astype(np.float32) / 255.0
+        
+        # Load mask
+        mask = np.array(Image.open(self.data_dir / overlay_file).convert('L'))
+        mask = cv2_resize(mask, self.staff_size)
+        mask = (mask > 127).astype(np.float32)
+        return img, np.expand_dims(mask, axis=-1)
+    
+    def _load_symbol_image(self, filename):
+        """Load one symbol image"""
+        img = np.array(Image.open(self.data_dir / filename).convert('RGB'))
+        img = cv2_resize(img, self.symbol_size)
+        return img.astype(np.float32) / 255.0
     
     def load_symbol_recognition_data(self):
         """Load individual symbols for classification"""
-        symbol_files = {}
-        
-        # Map symbol files to classes
-        for f in os.listdir(self.data_dir):
-            if f.endswith('.png') and not f.startswith('overlay'):
-                parts = f.split('_')
-                if len(parts) >= 2 and parts[0].isdigit():
-                    class_id = parts[0]
-                    if class_id not in symbol_files:
-                        symbol_files[class_id] = []
-                    symbol_files[class_id].append(f)
+        _, _, symbol_files = self._index_data_dir()
         
         self.symbol_classes = {v: k for k, v in enumerate(symbol_files.keys())}
         num_classes = len(self.symbol_classes)
@@ -96,65 +120,67 @@ class FastDataLoader:
         print(f"Loading symbol recognition data ({num_classes} classes)...")
         print(f"Classes: {list(symbol_files.keys())}")
         
-        for class_id, files in symbol_files.items():
-            class_idx = self.symbol_classes[class_id]
-            for f in files:
-                img_path = self.data_dir / f
-                img = np.array(Image.open(img_path).convert('RGB'))
-                img = cv2_resize(img, self.symbol_size)
-                img = img.astype(np.float32) / 255.0
+        entries = [(class_id, f) for class_id, files in symbol_files.items() for f in files]
+        
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            loaded = executor.map(self._load_symbol_image, [f for _, f in entries])
+            for (class_id, _), img in zip(entries, loaded):
                 images.append(img)
-                labels.append(class_idx)
-                print(f"  Loaded {f} -> class {class_id}")
+                labels.append(self.symbol_classes[class_id])
         
+        for class_id, files in symbol_files.items():
+            print(f"  class {class_id}: {len(files)} images")
         print(f"✓ Loaded {len(images)} symbols")
-        return np.array(images), np.array(labels), num_classes
-    
-    def augment_staff_data(self, images, masks):
-        """Minimal data augmentation"""
-        augmented_images = [images]
-        augmented_masks = [masks]
-        
-        # Brightness variation
-        aug_imgs = []
-        aug_masks = []
-        for img, mask in zip(images, masks):
-            bright_img = np.clip(img * np.random.uniform(0.85, 1.15), 0, 1)
-            aug_imgs.append(bright_img)
-            aug_masks.append(mask)
-        augmented_images.append(np.array(aug_imgs))
-        augmented_masks.append(np.array(aug_masks))
-        
-        return np.vstack(augmented_images), np.vstack(augmented_masks)
+        return np.asarray(images), np.asarray(labels), num_classes
+
+def augment_staff_sample(image, mask):
+    """Minimal data augmentation (TF ops, runs inside the tf.data pipeline)"""
+    # Brightness variation
+    factor = tf.random.uniform([], 0.85, 1.15)
+    return tf.clip_by_value(image * factor, 0.0, 1.0), mask
+
+def make_dataset(images, labels, training=False, augment_fn=None):
+    """Build a batched, prefetched tf.data pipeline over in-memory arrays"""
+    ds = tf.data.Dataset.from_tensor_slices((images, labels)).cache()
+    if training:
+        ds = ds.shuffle(1024)
+        if augment_fn is not None:
+            ds = ds.map(augment_fn, num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.batch(CONFIG['batch_size']).prefetch(tf.data.AUTOTUNE)
 
 class FastStaffDetectorModel:
-    """Minimal U-Net for staff detection"""
+    """Minimal U-Net for staff detection (depthwise-separable convs)"""
     
     @staticmethod
     def build(input_shape):
         """Build compact segmentation model"""
         inputs = keras.Input(shape=input_shape)
         
-        # Compact encoder
-        c1 = layers.Conv2D(16, 3, activation='relu', padding='same')(inputs)
+        # Compact encoder (first conv stays dense: 3 input channels gain nothing from separable)
+        c1 = layers.Conv2D(16, 3, padding='same')(inputs)
+        c1 = layers.ReLU(6.0)(c1)
         p1 = layers.MaxPooling2D((2, 2))(c1)
         
-        c2 = layers.Conv2D(32, 3, activation='relu', padding='same')(p1)
+        c2 = layers.SeparableConv2D(32, 3, padding='same')(p1)
+        c2 = layers.ReLU(6.0)(c2)
         p2 = layers.MaxPooling2D((2, 2))(c2)
         
-        c3 = layers.Conv2D(64, 3, activation='relu', padding='same')(p2)
+        c3 = layers.SeparableConv2D(64, 3, padding='same')(p2)
+        c3 = layers.ReLU(6.0)(c3)
         
         # Decoder
         u4 = layers.UpSampling2D((2, 2))(c3)
         u4 = layers.concatenate([u4, c2])
-        c4 = layers.Conv2D(32, 3, activation='relu', padding='same')(u4)
+        c4 = layers.SeparableConv2D(32, 3, padding='same')(u4)
+        c4 = layers.ReLU(6.0)(c4)
         
         u5 = layers.UpSampling2D((2, 2))(c4)
         u5 = layers.concatenate([u5, c1])
-        c5 = layers.Conv2D(16, 3, activation='relu', padding='same')(u5)
+        c5 = layers.SeparableConv2D(16, 3, padding='same')(u5)
+        c5 = layers.ReLU(6.0)(c5)
         
         # Output
-        outputs = layers.Conv2D(1, 1, activation='sigmoid')(c5)
+        outputs = layers.Conv2D(1, 1, activation='sigmoid', dtype='float32')(c5)
         
         model = keras.Model(inputs=inputs, outputs=outputs)
         model.compile(
@@ -165,7 +191,7 @@ class FastStaffDetectorModel:
         return model
 
 class FastSymbolRecognizerModel:
-    """Compact CNN for symbol classification"""
+    """Compact CNN for symbol classification (depthwise-separable convs)"""
     
     @staticmethod
     def build(input_shape, num_classes):
@@ -173,18 +199,21 @@ class FastSymbolRecognizerModel:
         model = keras.Sequential([
             keras.Input(shape=input_shape),
             
-            layers.Conv2D(16, 3, activation='relu', padding='same'),
+            layers.Conv2D(16, 3, padding='same'),
+            layers.ReLU(6.0),
             layers.MaxPooling2D((2, 2)),
             layers.Dropout(0.2),
             
-            layers.Conv2D(32, 3, activation='relu', padding='same'),
+            layers.SeparableConv2D(32, 3, padding='same'),
+            layers.ReLU(6.0),
             layers.MaxPooling2D((2, 2)),
             layers.Dropout(0.2),
             
             layers.Flatten(),
-            layers.Dense(128, activation='relu'),
+            layers.Dense(128),
+            layers.ReLU(6.0),
             layers.Dropout(0.3),
-            layers.Dense(num_classes, activation='softmax')
+            layers.Dense(num_classes, activation='softmax', dtype='float32')
         ])
         
         model.compile(
@@ -194,6 +223,17 @@ class FastSymbolRecognizerModel:
         )
         return model
 
+def save_float32(model, build_fn, path):
+    """Save a float32 copy of a (possibly mixed-precision) model for TFLite conversion"""
+    policy = keras.mixed_precision.global_policy()
+    keras.mixed_precision.set_global_policy('float32')
+    try:
+        export_model = build_fn()
+        export_model.set_weights(model.get_weights())
+        export_model.save(path)
+    finally:
+        keras.mixed_precision.set_global_policy(policy)
+
 def train_models():
     """Main training function"""
     os.makedirs(CONFIG['output_dir'], exist_ok=True)
@@ -212,10 +252,6 @@ def train_models():
     # Staff detection data
     staff_images, staff_masks = loader.load_staff_detection_data()
     
-    if CONFIG['augmentation']:
-        print("Applying data augmentation...")
-        staff_images, staff_masks = loader.augment_staff_data(staff_images, staff_masks)
-    
     X_staff_train, X_staff_val, y_staff_train, y_staff_val = train_test_split(
         staff_images, staff_masks, test_size=0.2, random_state=42
     )
@@ -232,25 +268,41 @@ def train_models():
         X_symbol_train, y_symbol_train = symbol_images, symbol_labels
         X_symbol_val, y_symbol_val = symbol_images[:1], symbol_labels[:1]
     
+    if CONFIG['mixed_precision']:
+        # Compute in 16-bit, keep variables in float32; compile() adds loss scaling for float16.
+        # bf16 is emulated (slower) on CPUs without native support, so CPU needs an opt-in
+        if tf.config.list_physical_devices('GPU'):
+            policy = 'mixed_float16'
+        elif CONFIG['bfloat16_on_cpu']:
+            policy = 'mixed_bfloat16'
+        else:
+            policy = 'float32'
+        keras.mixed_precision.set_global_policy(policy)
+        print(f"Mixed precision policy: {policy}")
+    
     print("\n" + "="*60)
     print("TRAINING STAFF DETECTION MODEL")
     print("="*60)
     
     # Train staff detector
-    staff_model = FastStaffDetectorModel.build(
+    build_staff_model = functools.partial(
+        FastStaffDetectorModel.build,
         input_shape=(*CONFIG['staff_detector_input_size'], 3)
     )
+    staff_model = build_staff_model()
     
     print(f"Training samples: {len(X_staff_train)}, Validation samples: {len(X_staff_val)}")
+    if CONFIG['augmentation']:
+        print("Data augmentation: random brightness per sample, applied in the training dataset map")
     staff_history = staff_model.fit(
-        X_staff_train, y_staff_train,
-        validation_data=(X_staff_val, y_staff_val),
+        make_dataset(X_staff_train, y_staff_train, training=True,
+                     augment_fn=augment_staff_sample if CONFIG['augmentation'] else None),
+        validation_data=make_dataset(X_staff_val, y_staff_val),
         epochs=CONFIG['epochs'],
-        batch_size=CONFIG['batch_size'],
         verbose=1
     )
     
-    staff_model.save(os.path.join(CONFIG['output_dir'], 'staff_detector.h5'))
+    save_float32(staff_model, build_staff_model, os.path.join(CONFIG['output_dir'], 'staff_detector.h5'))
     print("✓ Saved staff_detector.h5")
     
     print("\n" + "="*60)
@@ -258,21 +310,22 @@ def train_models():
     print("="*60)
     
     # Train symbol recognizer
-    symbol_model = FastSymbolRecognizerModel.build(
+    build_symbol_model = functools.partial(
+        FastSymbolRecognizerModel.build,
         input_shape=(*CONFIG['symbol_recognizer_input_size'], 3),
         num_classes=num_classes
     )
+    symbol_model = build_symbol_model()
     
     print(f"Training samples: {len(X_symbol_train)}, Validation samples: {len(X_symbol_val)}")
     symbol_history = symbol_model.fit(
-        X_symbol_train, y_symbol_train,
-        validation_data=(X_symbol_val, y_symbol_val),
+        make_dataset(X_symbol_train, y_symbol_train, training=True),
+        validation_data=make_dataset(X_symbol_val, y_symbol_val),
         epochs=CONFIG['epochs'],
-        batch_size=CONFIG['batch_size'],
         verbose=1
     )
     
-    symbol_model.save(os.path.join(CONFIG['output_dir'], 'symbol_recognizer.h5'))
+    save_float32(symbol_model, build_symbol_model, os.path.join(CONFIG['output_dir'], 'symbol_recognizer.h5'))
     print("✓ Saved symbol_recognizer.h5")
     
     # Save training metadata